@@ -1,22 +1,78 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
 import os
+import random
+import re
 import textwrap
-from typing import List, Dict, Any, Optional
-
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html import unescape
+from urllib.parse import unquote, urlparse
+from typing import TYPE_CHECKING, List, Dict, Any, Optional
+
+import diskcache
+import numpy as np
 import requests
 import streamlit as st
-import streamlit.components.v1 as components
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# openai and streamlit.components are imported where they are used: Streamlit re-runs this
+# script on every interaction, and most reruns never reach a rewrite or a preview.
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
 
 
 # ---------- CONFIG / CLIENTS ----------
 
-def get_ai_client() -> OpenAI:
+CACHE_DIR = os.getenv("COURSE_REWRITER_CACHE_DIR", ".cache")
+
+# Retries: the OpenAI client backs off exponentially (with jitter, honouring Retry-After)
+# on 429/5xx. Canvas calls retry 429/5xx through urllib3, retry Canvas' own throttle
+# (403 "Rate Limit Exceeded") in canvas_request, and slow down as the rate-limit bucket drains.
+OPENAI_MAX_RETRIES = 5
+CANVAS_MAX_RETRIES = 5
+CANVAS_BACKOFF_SECONDS = 0.5
+CANVAS_RATE_LIMIT_FLOOR = 100.0
+CANVAS_MAX_THROTTLE_SECONDS = 2.0
+
+# Batching: items are grouped until their HTML reaches roughly this many input tokens.
+# Token counts are estimated from character length (~4 chars per token for HTML/English).
+BATCH_INPUT_TOKENS = 6000
+BATCH_MAX_ITEMS = 8
+CHARS_PER_TOKEN = 4
+
+# Model context gets whatever is left of this per-prompt budget once the item HTML is in,
+# clamped so it never disappears entirely nor grows past the old fixed cap.
+PROMPT_TOKEN_BUDGET = 8000
+MODEL_CONTEXT_MIN_CHARS = 4000
+MODEL_CONTEXT_MAX_CHARS = 12000
+
+# Progress/status widgets are redrawn at most this often; each redraw is a frontend message.
+UI_REFRESH_SECONDS = 0.1
+
+# Items with less visible text than this (and no embedded media) are left as they are.
+MIN_REWRITE_TEXT_CHARS = 40
+
+# When an embedding deployment is configured, each item only sees its most similar model snippets.
+# A batch gets the best-scoring snippets across its items, capped at BATCH_MODEL_SNIPPETS.
+MODEL_SNIPPETS_PER_ITEM = 3
+BATCH_MODEL_SNIPPETS = 2 * MODEL_SNIPPETS_PER_ITEM
+EMBED_INPUT_CHARS = 2000
+
+
+def get_ai_client(async_client: bool = False) -> OpenAI | AsyncOpenAI:
     """
     Create an OpenAI client for an Azure AI Foundry / Project endpoint.
 
     Required config (Streamlit secrets OR env vars):
       - OPENAI_BASE_URL  e.g. "https://<something>.services.ai.azure.com/openai/v1"
       - OPENAI_API_KEY   e.g. the key from the Foundry 'Use this model' / 'Connections' blade
+
+    Pass async_client=True to get an AsyncOpenAI client for concurrent rewrites.
     """
     base_url = (
         st.secrets.get("OPENAI_BASE_URL", None)
@@ -35,13 +91,43 @@ def get_ai_client() -> OpenAI:
         )
         st.stop()
 
-    client = OpenAI(
+    from openai import AsyncOpenAI, OpenAI
+
+    client_cls = AsyncOpenAI if async_client else OpenAI
+    client = client_cls(
         base_url=base_url,
         api_key=api_key,
+        max_retries=OPENAI_MAX_RETRIES,
     )
     return client
 
 
+def get_model_name() -> str:
+    """
+    Model identifier should be the *deployment name* from Foundry,
+    same value that worked for your dashboard (e.g. "gpt-4.1-dashboard").
+    """
+    model_name = (
+        st.secrets.get("OPENAI_MODEL", None)
+        or os.getenv("OPENAI_MODEL")
+    )
+    if not model_name:
+        st.error(
+            "OPENAI_MODEL is not set. "
+            "Set it to your model deployment name from Azure (Deployment Info → Name)."
+        )
+        st.stop()
+    return model_name
+
+
+def get_embedding_model() -> Optional[str]:
+    """
+    Optional embedding deployment name (e.g. "text-embedding-3-small").
+    When unset, the whole model context is sent with every item.
+    """
+    return st.secrets.get("OPENAI_EMBEDDING_MODEL", None) or os.getenv("OPENAI_EMBEDDING_MODEL")
+
+
 def get_canvas_config() -> tuple[str, str]:
     """Fetch Canvas base URL and API token from secrets/env, or stop if missing."""
     base_url = st.secrets.get("CANVAS_BASE_URL", None) or os.getenv("CANVAS_BASE_URL")
@@ -57,174 +143,402 @@ def get_canvas_config() -> tuple[str, str]:
 
 # ---------- CANVAS HELPERS ----------
 
-def canvas_headers(token: str) -> Dict[str, str]:
-    return {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+def _throttle_canvas(resp: requests.Response, *args: Any, **kwargs: Any) -> None:
+    """
+    Response hook: Canvas reports its remaining rate-limit budget per response.
+    Sleep in proportion to how far it has dropped below the floor, before Canvas starts refusing calls.
+    """
+    try:
+        remaining = float(resp.headers.get("X-Rate-Limit-Remaining", ""))
+    except ValueError:
+        return
+    if remaining < CANVAS_RATE_LIMIT_FLOOR:
+        shortfall = (CANVAS_RATE_LIMIT_FLOOR - max(remaining, 0.0)) / CANVAS_RATE_LIMIT_FLOOR
+        time.sleep(shortfall * CANVAS_MAX_THROTTLE_SECONDS)
+
+
+def _canvas_rate_limited(resp: requests.Response) -> bool:
+    """Canvas refuses throttled calls with 403 Forbidden (Rate Limit Exceeded), not 429."""
+    if resp.status_code != 403:
+        return False
+    if "Rate Limit Exceeded" in resp.text:
+        return True
+    try:
+        return float(resp.headers.get("X-Rate-Limit-Remaining", "")) <= 1.0
+    except ValueError:
+        return False
+
+
+def canvas_request(session: requests.Session, method: str, url: str, **kwargs: Any) -> requests.Response:
+    """
+    Send a Canvas API request, retrying Canvas rate-limit refusals with exponential backoff
+    (plus jitter, so parallel workers don't retry in lockstep). Raises for any other error status.
+    """
+    for attempt in range(CANVAS_MAX_RETRIES + 1):
+        resp = session.request(method, url, **kwargs)
+        if not _canvas_rate_limited(resp) or attempt == CANVAS_MAX_RETRIES:
+            break
+        time.sleep(CANVAS_BACKOFF_SECONDS * 2**attempt * (1 + random.random()))
+    resp.raise_for_status()
+    return resp
+
+
+@st.cache_resource(show_spinner=False)
+def canvas_session(token: str) -> requests.Session:
+    """
+    Keep-alive session shared by all Canvas helpers (one per API token).
+    Cached as a resource so the connection pool survives Streamlit reruns.
+    """
+    session = requests.Session()
+    retries = Retry(
+        total=CANVAS_MAX_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],  # 429 from proxies; Canvas' own 403 is canvas_request's
+        raise_on_status=False,  # hand the last response back so raise_for_status() reports it
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retries)
+    session.mount("https://", adapter)
+    # Session's default Accept-Encoding already asks for gzip/deflate (plus br/zstd when
+    # those decoders are installed) and decompresses transparently, so it is left as is.
+    session.headers.update({"Authorization": f"Bearer {token}"})
+    session.hooks["response"].append(_throttle_canvas)
+    return session
 
 
 def get_course(base_url: str, token: str, course_id: str) -> Dict[str, Any]:
     url = f"{base_url}/api/v1/courses/{course_id}"
-    resp = requests.get(url, headers=canvas_headers(token))
-    resp.raise_for_status()
+    resp = canvas_request(canvas_session(token), "GET", url)
     return resp.json()
 
 
+def _next_link(resp: requests.Response) -> Optional[str]:
+    """URL of the next page from Canvas' Link header, or None on the last page."""
+    links = requests.utils.parse_header_links(resp.headers.get("Link", ""))
+    return next((link["url"] for link in links if link.get("rel") == "next"), None)
+
+
 def _paginate_canvas(base_url: str, token: str, url: str, params: Optional[Dict[str, Any]] = None):
     """Generic Canvas pagination helper (not heavily used here, but available)."""
-    headers = canvas_headers(token)
+    session = canvas_session(token)
     items: List[Any] = []
     while url:
-        resp = requests.get(url, headers=headers, params=params)
-        resp.raise_for_status()
+        resp = canvas_request(session, "GET", url, params=params)
         data = resp.json()
         items.extend(data if isinstance(data, list) else data)
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<") + 1 : part.find(">")]
-                break
-        url = next_url
+        url = _next_link(resp)
         params = None  # only on first call
     return items
 
 
+def _get_page_detail(session: requests.Session, url: str) -> Dict[str, Any]:
+    return canvas_request(session, "GET", url).json()
+
+
 def get_pages(base_url: str, token: str, course_id: str, max_items: Optional[int] = None) -> List[Dict[str, Any]]:
     """Return list of full page objects (with body)."""
-    headers = canvas_headers(token)
+    session = canvas_session(token)
     items: List[Dict[str, Any]] = []
     url = f"{base_url}/api/v1/courses/{course_id}/pages"
-    params = {"per_page": 100}
-
-    while url:
-        resp = requests.get(url, headers=headers, params=params)
-        resp.raise_for_status()
-        for page in resp.json():
-            # Need a second call to get full body
-            detail_url = f"{base_url}/api/v1/courses/{course_id}/pages/{page['url']}"
-            detail_resp = requests.get(detail_url, headers=headers)
-            detail_resp.raise_for_status()
-            full_page = detail_resp.json()
-            items.append(full_page)
+    params = {"per_page": 100, "include[]": "body"}
+
+    # Canvas returns bodies in the listing when it honours include[]=body. Older installs
+    # omit the key, so those pages need a second call; run those concurrently.
+    with ThreadPoolExecutor(max_workers=16) as ex:
+        while url:
+            resp = canvas_request(session, "GET", url, params=params)
+            listing = resp.json()
+            if max_items:
+                listing = listing[: max_items - len(items)]
+
+            missing = [p for p in listing if "body" not in p]
+            detail_urls = [f"{base_url}/api/v1/courses/{course_id}/pages/{p['url']}" for p in missing]
+            # map() keeps Canvas ordering and re-raises the first failed fetch
+            details = iter(ex.map(lambda u: _get_page_detail(session, u), detail_urls))
+            items.extend(next(details) if "body" not in p else p for p in listing)
             if max_items and len(items) >= max_items:
                 return items
 
-        # Pagination – Canvas uses Link header
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<") + 1 : part.find(">")]
-                break
-        url = next_url
+            # Pagination – Canvas uses Link header
+            url = _next_link(resp)
 
     return items
 
 
+PAGES_GRAPHQL_QUERY = """
+query CoursePages($id: ID!, $first: Int!, $after: String) {
+  course(id: $id) {
+    pagesConnection(first: $first, after: $after) {
+      nodes { _id title url body }
+      pageInfo { endCursor hasNextPage }
+    }
+  }
+}
+"""
+
+
+def _page_slug(page_url: str) -> str:
+    """REST slug from a GraphQL Page.url, which is the page's full URL (.../courses/1/pages/<slug>)."""
+    path = urlparse(page_url).path.rstrip("/")
+    if "/pages/" not in path:
+        raise ValueError(f"Unexpected Canvas page URL: {page_url!r}")
+    return unquote(path.rsplit("/pages/", 1)[1])
+
+
+def get_pages_graphql(base_url: str, token: str, course_id: str, max_items: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Return pages with bodies through Canvas GraphQL, up to 200 per POST, shaped like the
+    REST page objects (page_id, url slug, title, body). Raises if the install can't answer the query
+    or leaves page bodies out of its answer.
+    """
+    session = canvas_session(token)
+    items: List[Dict[str, Any]] = []
+    after: Optional[str] = None
+
+    while True:
+        first = min(200, max_items - len(items)) if max_items else 200
+        resp = canvas_request(
+            session,
+            "POST",
+            f"{base_url}/api/graphql",
+            json={"query": PAGES_GRAPHQL_QUERY, "variables": {"id": course_id, "first": first, "after": after}},
+        )
+        payload = resp.json()
+        if payload.get("errors"):
+            raise RuntimeError(f"Canvas GraphQL error: {payload['errors'][0].get('message')}")
+        course = (payload.get("data") or {}).get("course")
+        if course is None:
+            raise RuntimeError(f"Course {course_id} not found via GraphQL.")
+
+        connection = course["pagesConnection"]
+        for node in connection["nodes"]:
+            if node.get("body") is None:
+                # Some installs answer the query but leave bodies out; let fetch_pages use REST
+                raise RuntimeError(f"Canvas GraphQL returned no body for page {node['_id']}.")
+            items.append(
+                {
+                    "page_id": int(node["_id"]),
+                    "url": _page_slug(node["url"]),
+                    "title": node["title"],
+                    "body": node["body"],
+                }
+            )
+            if max_items and len(items) >= max_items:
+                return items
+
+        if not connection["pageInfo"]["hasNextPage"]:
+            return items
+        after = connection["pageInfo"]["endCursor"]
+
+
+def fetch_pages(base_url: str, token: str, course_id: str, max_items: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Fetch pages in bulk over GraphQL, falling back to REST on installs where that fails."""
+    try:
+        return get_pages_graphql(base_url, token, course_id, max_items=max_items)
+    except Exception:
+        return get_pages(base_url, token, course_id, max_items=max_items)
+
+
 def get_assignments(base_url: str, token: str, course_id: str, max_items: Optional[int] = None) -> List[Dict[str, Any]]:
-    headers = canvas_headers(token)
+    """Return list of assignments; the list endpoint already includes `description`."""
+    session = canvas_session(token)
     items: List[Dict[str, Any]] = []
     url = f"{base_url}/api/v1/courses/{course_id}/assignments"
     params = {"per_page": 100}
 
     while url:
-        resp = requests.get(url, headers=headers, params=params)
-        resp.raise_for_status()
+        resp = canvas_request(session, "GET", url, params=params)
         data = resp.json()
         items.extend(data)
         if max_items and len(items) >= max_items:
             return items[:max_items]
 
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<") + 1 : part.find(">")]
-                break
-        url = next_url
+        url = _next_link(resp)
 
     return items
 
 
 def get_discussions(base_url: str, token: str, course_id: str, max_items: Optional[int] = None) -> List[Dict[str, Any]]:
-    headers = canvas_headers(token)
+    """Return list of discussion topics; the list endpoint already includes `message`."""
+    session = canvas_session(token)
     items: List[Dict[str, Any]] = []
     url = f"{base_url}/api/v1/courses/{course_id}/discussion_topics"
     params = {"per_page": 100}
 
     while url:
-        resp = requests.get(url, headers=headers, params=params)
-        resp.raise_for_status()
+        resp = canvas_request(session, "GET", url, params=params)
         data = resp.json()
         items.extend(data)
         if max_items and len(items) >= max_items:
             return items[:max_items]
 
-        link = resp.headers.get("Link", "")
-        next_url = None
-        for part in link.split(","):
-            if 'rel="next"' in part:
-                next_url = part[part.find("<") + 1 : part.find(">")]
-                break
-        url = next_url
+        url = _next_link(resp)
 
     return items
 
 
-def update_page_html(base_url: str, token: str, course_id: str, url_slug: str, html: str) -> None:
-    endpoint = f"{base_url}/api/v1/courses/{course_id}/pages/{url_slug}"
+def update_page_html(base_url: str, token: str, course_id: str, url_or_id: str | int, html: str) -> None:
+    endpoint = f"{base_url}/api/v1/courses/{course_id}/pages/{url_or_id}"
     payload = {"wiki_page": {"body": html}}
-    resp = requests.put(endpoint, headers=canvas_headers(token), json=payload)
-    resp.raise_for_status()
+    canvas_request(canvas_session(token), "PUT", endpoint, json=payload)
 
 
 def update_assignment_html(base_url: str, token: str, course_id: str, assignment_id: int, html: str) -> None:
     endpoint = f"{base_url}/api/v1/courses/{course_id}/assignments/{assignment_id}"
     payload = {"assignment": {"description": html}}
-    resp = requests.put(endpoint, headers=canvas_headers(token), json=payload)
-    resp.raise_for_status()
+    canvas_request(canvas_session(token), "PUT", endpoint, json=payload)
 
 
 def update_discussion_html(base_url: str, token: str, course_id: str, topic_id: int, html: str) -> None:
     endpoint = f"{base_url}/api/v1/courses/{course_id}/discussion_topics/{topic_id}"
     payload = {"message": html}
-    resp = requests.put(endpoint, headers=canvas_headers(token), json=payload)
-    resp.raise_for_status()
+    canvas_request(canvas_session(token), "PUT", endpoint, json=payload)
+
+
+def update_item_html(base_url: str, token: str, course_id: str, item: Dict[str, Any]) -> None:
+    """Write an item's rewritten HTML back to Canvas using the endpoint for its type."""
+    if item["type"] == "page":
+        # Pages are addressed by id: unlike the slug it can't be mis-derived and survives title changes
+        update_page_html(base_url, token, course_id, item["canvas_id"], item["rewritten_html"])
+    elif item["type"] == "assignment":
+        update_assignment_html(base_url, token, course_id, item["canvas_id"], item["rewritten_html"])
+    elif item["type"] == "discussion":
+        update_discussion_html(base_url, token, course_id, item["canvas_id"], item["rewritten_html"])
 
 
 # ---------- OPENAI HELPERS ----------
 
+@st.cache_resource(show_spinner=False)
+def rewrite_cache() -> diskcache.Cache:
+    """
+    On-disk store of finished rewrites keyed by (sha256(prompt), model name).
+    Survives reruns, sessions and redeploys, so identical prompts never hit the API twice.
+    """
+    return diskcache.Cache(os.path.join(CACHE_DIR, "rewrites"), size_limit=256 * 1024 * 1024)
+
+
+@st.cache_resource(show_spinner=False)
+def data_uri_store() -> diskcache.Cache:
+    """
+    Content-addressed store of the data URIs stashed out of prompts. Never evicts, so every
+    placeholder a cached rewrite can contain is still restorable.
+    """
+    return diskcache.Cache(os.path.join(CACHE_DIR, "data_uris"), eviction_policy="none")
+
+
+_BASE_RULES = textwrap.dedent(
+    """
+    You are an expert Canvas HTML editor. Preserve links and anchors/IDs
+
+    Requirements:
+    - Preserve semantics and learning intent of the original.
+    - Follow the policy. Return only HTML, no explanations.
+    - Reformat the HTML using DesignPLUS styling.
+    - Do not change the written content of the page, only the design.
+    - Use Colorado State University branding colors.
+    - Use the DesignPLUS theme from the model provided.
+    - Place all iframes within DesignPLUS accordions.
+    - The focus is on styling, structure, and accessibility — not changing the content.
+    """
+)
+
+_MEDIA_RE = re.compile(r"<(iframe|img|video|audio|table|object|embed)\b", re.I)
+_TAG_RE = re.compile(r"<[^>]+>")
+_COMMENT_RE = re.compile(r"<!--.*?-->", re.S)
+# Only real data URIs (scheme, mime type, comma, long payload) — never prose like "metadata:"
+_DATAURI_RE = re.compile(r"\bdata:[\w.+-]+/[\w.+-]+(?:;[\w=.+-]+)*(?:;base64)?,[^\"'\s)]{200,}")
+_STASHED_RE = re.compile(r"\bdata:stashed/([0-9a-f]{16})")
+_PRESERVE_WS_RE = re.compile(r"(<(pre|textarea|script)\b.*?</\2\s*>)", re.S | re.I)
+_WS_RE = re.compile(r"\s+")
+
+
+def html_hash(html: str) -> str:
+    """Content hash used to spot items that share identical HTML."""
+    return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+
+def _significant(html: str) -> bool:
+    """Whether an item has enough content (visible text or embedded media) to be worth a rewrite call."""
+    if _MEDIA_RE.search(html):
+        return True
+    text = unescape(_TAG_RE.sub("", html))
+    return len(text.strip()) >= MIN_REWRITE_TEXT_CHARS
+
+
+def _rewrite_cache_key(prompt: str, model_name: str) -> tuple[str, str]:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest(), model_name
+
+
+def _compact_html(html: str) -> str:
+    """
+    Drop bytes that cost tokens but mean nothing to the model: comments and runs of
+    whitespace (left alone inside <pre>, <textarea> and <script>). Data URIs are
+    handled separately by _stash_data_uris, which is reversible.
+    """
+    html = _COMMENT_RE.sub("", html)
+    parts = _PRESERVE_WS_RE.split(html)
+    # split() yields [text, block, tag-name, text, block, tag-name, ...]
+    return "".join(
+        _WS_RE.sub(" ", part) if i % 3 == 0 else part
+        for i, part in enumerate(parts)
+        if i % 3 != 2
+    ).strip()
+
+
+def _stash_data_uris(html: str) -> str:
+    """
+    Swap long data URIs for short content-addressed placeholders (data:stashed/<hash>).
+    The URIs go to data_uri_store(), so _restore_data_uris can put them back into any
+    model output — including one that copied a placeholder from the model context.
+    """
+    store = data_uri_store()
+
+    def _stash(match: re.Match) -> str:
+        uri = match.group(0)
+        digest = hashlib.sha256(uri.encode("utf-8")).hexdigest()[:16]
+        store.add(digest, uri)  # no-op when already stored
+        return f"data:stashed/{digest}"
+
+    return _DATAURI_RE.sub(_stash, html)
+
+
+def _restore_data_uris(html: str) -> str:
+    if "data:stashed/" not in html:
+        return html
+    store = data_uri_store()
+    return _STASHED_RE.sub(lambda m: store.get(m.group(1), m.group(0)), html)
+
+
+def _prompt_html(item: Dict[str, Any]) -> str:
+    """Item HTML as sent to the model: data URIs stashed, then compacted."""
+    return _compact_html(_stash_data_uris(item.get("original_html", "")))
+
+
+def _truncate_model_context(model_context: str, used_chars: int = 0) -> str:
+    """
+    Trim model context to what fits in PROMPT_TOKEN_BUDGET after `used_chars` of item HTML,
+    cutting at a snippet boundary where possible.
+    """
+    model_context = (model_context or "").strip()
+    max_model_chars = PROMPT_TOKEN_BUDGET * CHARS_PER_TOKEN - used_chars
+    max_model_chars = min(max(max_model_chars, MODEL_CONTEXT_MIN_CHARS), MODEL_CONTEXT_MAX_CHARS)
+    if len(model_context) > max_model_chars:
+        cut = model_context.rfind("\n\n### ", 0, max_model_chars)
+        if cut <= 0:
+            cut = max_model_chars
+        model_context = model_context[:cut] + "\n\n[Model context truncated for length.]"
+    return model_context
+
+
 def build_rewrite_prompt(
     item: Dict[str, Any],
     model_context: str,
     global_instructions: str,
 ) -> str:
     """Build a single string prompt for the Responses API."""
-    model_context = (model_context or "").strip()
-    # Truncate model context for safety
-    max_model_chars = 12000
-    if len(model_context) > max_model_chars:
-        model_context = model_context[:max_model_chars] + "\n\n[Model context truncated for length.]"
-
-    base_rules = textwrap.dedent(
-        """
-        You are an expert Canvas HTML editor. Preserve links and anchors/IDs
-
-        Requirements:
-        - Preserve semantics and learning intent of the original.
-        - Follow the policy. Return only HTML, no explanations.
-        - Reformat the HTML using DesignPLUS styling.
-        - Do not change the written content of the page, only the design.
-        - Use Colorado State University branding colors.
-        - Use the DesignPLUS theme from the model provided.
-        - Place all iframes within DesignPLUS accordions.
-        - The focus is on styling, structure, and accessibility — not changing the content.
-        """
-    )
+    item_html = _prompt_html(item)
+    model_context = _truncate_model_context(model_context, len(item_html))
+    base_rules = _BASE_RULES
 
-    item_html = item.get("original_html", "")
     item_type = item.get("type", "page")
     title = item.get("title", "")
 
@@ -252,32 +566,156 @@ def build_rewrite_prompt(
     return prompt
 
 
-def rewrite_item(
-    client: OpenAI,
+def build_batch_prompt(
+    items_batch: List[Dict[str, Any]],
+    model_context: str,
+    global_instructions: str,
+) -> str:
+    """Build one prompt that asks for a JSON object with a rewrite for every item in the batch."""
+    targets = json.dumps(
+        [
+            {
+                "id": str(pos),
+                "type": item.get("type", "page"),
+                "title": item.get("title", ""),
+                "html": _prompt_html(item),
+            }
+            for pos, item in enumerate(items_batch)
+        ],
+        ensure_ascii=False,
+    )
+    model_context = _truncate_model_context(model_context, len(targets))
+    base_rules = _BASE_RULES
+
+    prompt = f"""
+    {base_rules}
+
+    ### Global instructions from the user
+    {global_instructions or "If no additional instructions, just clean up structure and align with the model course style."}
+
+    ### Model course/style examples
+    {model_context}
+
+    ### Target items (JSON array of {{id, type, title, html}})
+    {targets}
+
+    ### Output
+    Rewrite the HTML of EVERY target item according to the global instructions and style of the model course.
+    Respond with a JSON object of the form {{"rewrites": [{{"id": "<id>", "html": "<rewritten HTML>"}}]}}
+    containing exactly one entry per target item, using the ids given above.
+    """.strip()
+
+    return prompt
+
+
+def plan_rewrite_batches(
+    items: List[Dict[str, Any]],
+    token_budget: int = BATCH_INPUT_TOKENS,
+    max_items: int = BATCH_MAX_ITEMS,
+) -> List[List[Dict[str, Any]]]:
+    """
+    Group items into batches whose combined HTML fits the per-call token budget.
+    An item that exceeds the budget on its own gets a batch of one (a normal single-item call).
+    """
+    char_budget = token_budget * CHARS_PER_TOKEN
+    batches: List[List[Dict[str, Any]]] = []
+    current: List[Dict[str, Any]] = []
+    current_chars = 0
+
+    for item in items:
+        size = len(item.get("original_html", "")) + len(item.get("title", ""))
+        if size > char_budget:
+            batches.append([item])
+            continue
+        if current and (current_chars + size > char_budget or len(current) >= max_items):
+            batches.append(current)
+            current, current_chars = [], 0
+        current.append(item)
+        current_chars += size
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_texts(client: OpenAI, model: str, texts: List[str]) -> np.ndarray:
+    """Embed texts (in chunks the API accepts) and return L2-normalised row vectors."""
+    vectors: List[List[float]] = []
+    for start in range(0, len(texts), 256):
+        resp = client.embeddings.create(model=model, input=texts[start : start + 256])
+        vectors.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
+    arr = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(arr, axis=1, keepdims=True)
+    return arr / np.where(norms == 0, 1, norms)
+
+
+def top_snippets(
+    item_vecs: np.ndarray,
+    model_vecs: np.ndarray,
+    k: int = MODEL_SNIPPETS_PER_ITEM,
+) -> List[List[tuple[int, float]]]:
+    """(index, score) of the k model snippets most similar to each item, best first."""
+    scores = item_vecs @ model_vecs.T
+    return [[(int(j), float(row[j])) for j in np.argsort(-row)[:k]] for row in scores]
+
+
+def rank_batch_snippets(
+    ranked: List[List[tuple[int, float]]],
+    limit: int = BATCH_MODEL_SNIPPETS,
+) -> List[int]:
+    """Merge per-item rankings: each snippet scores its best match in the batch, best first."""
+    best: Dict[int, float] = {}
+    for pairs in ranked:
+        for j, score in pairs:
+            best[j] = max(score, best.get(j, score))
+    return sorted(best, key=best.get, reverse=True)[:limit]
+
+
+async def _stream_completion(
+    client: AsyncOpenAI,
+    deltas: Optional[asyncio.Queue],
+    label: str,
+    **kwargs: Any,
+) -> str:
+    """Run a streaming chat completion, forwarding each text delta to `deltas` as (label, text)."""
+    stream = await client.chat.completions.create(stream=True, **kwargs)
+    parts: List[str] = []
+    async for chunk in stream:
+        if not chunk.choices:
+            continue  # Azure sends a content-filter chunk with no choices first
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            parts.append(delta)
+            if deltas is not None:
+                deltas.put_nowait((label, delta))
+    return "".join(parts)
+
+
+async def rewrite_item_async(
+    client: AsyncOpenAI,
     item: Dict[str, Any],
     model_context: str,
     global_instructions: str,
+    model_name: str,
+    deltas: Optional[asyncio.Queue] = None,
 ) -> str:
     """
-    Call your Azure AI Foundry deployment via the OpenAI client to rewrite a single item.
+    Call your Azure AI Foundry deployment via the async OpenAI client to rewrite a single item.
     Uses Chat Completions API with a single user message containing the prompt.
+    The response is streamed; partial text is pushed onto `deltas` when a queue is given.
     """
     prompt = build_rewrite_prompt(item, model_context, global_instructions)
 
-    # Model identifier should be the *deployment name* from Foundry,
-    # same value that worked for your dashboard (e.g. "gpt-4.1-dashboard").
-    model_name = (
-        st.secrets.get("OPENAI_MODEL", None)
-        or os.getenv("OPENAI_MODEL")
-    )
-    if not model_name:
-        st.error(
-            "OPENAI_MODEL is not set. "
-            "Set it to your model deployment name from Azure (Deployment Info → Name)."
-        )
-        st.stop()
+    cache = rewrite_cache()
+    cache_key = _rewrite_cache_key(prompt, model_name)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return _restore_data_uris(cached)
 
-    resp = client.chat.completions.create(
+    out = await _stream_completion(
+        client,
+        deltas,
+        f"[{item.get('type', 'page')}] {item.get('title', '')}",
         model=model_name,
         messages=[
             {
@@ -288,18 +726,201 @@ def rewrite_item(
         temperature=0,  # deterministic; adjust if you want more variation
     )
 
-    out = resp.choices[0].message.content or ""
-    return out.strip()
+    out = out.strip()
+    if out:
+        cache.set(cache_key, out)
+    return _restore_data_uris(out)
 
 
+async def rewrite_items_batch(
+    client: AsyncOpenAI,
+    items_batch: List[Dict[str, Any]],
+    model_context: str,
+    global_instructions: str,
+    model_name: str,
+    deltas: Optional[asyncio.Queue] = None,
+    item_contexts: Optional[List[str]] = None,
+) -> List[str | Exception]:
+    """
+    Rewrite several items with a single JSON-mode chat completion.
+    Results are returned in the same order as items_batch. Items already in the rewrite
+    cache are not sent, and any item missing from the model's answer — or every pending item,
+    when the batched call itself fails — is retried on its own. An item whose own retry fails
+    gets that exception in its slot instead of a string, so one bad item can't sink its batch.
+    `item_contexts` gives each item its own model context (for cache keys and single-item
+    retries); `model_context` is what the batched prompt uses.
+    """
+    if item_contexts is None:
+        item_contexts = [model_context] * len(items_batch)
+    cache = rewrite_cache()
+    # Cache under each item's single-item prompt so batched and unbatched runs share hits,
+    # independent of which other items happen to share the batch
+    keys = [
+        _rewrite_cache_key(build_rewrite_prompt(item, context, global_instructions), model_name)
+        for item, context in zip(items_batch, item_contexts)
+    ]
+    results: List[Optional[str]] = [cache.get(key) for key in keys]
+    pending = [i for i, out in enumerate(results) if out is None]
+
+    if len(pending) > 1:
+        prompt = build_batch_prompt([items_batch[i] for i in pending], model_context, global_instructions)
+        try:
+            content = await _stream_completion(
+                client,
+                deltas,
+                f"Batch of {len(pending)} items",
+                model=model_name,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt,
+                    }
+                ],
+                response_format={"type": "json_object"},
+                temperature=0,
+            )
+            data = json.loads(content or "{}")
+        except Exception:
+            # Bad request, content filter, retries exhausted, unparseable JSON: go item by item
+            data = {}
+        rewrites = data.get("rewrites", []) if isinstance(data, dict) else []
+
+        for entry in rewrites:
+            try:
+                pos = int(entry["id"])
+                html = entry["html"].strip()
+            except (KeyError, TypeError, ValueError, AttributeError):
+                continue
+            if 0 <= pos < len(pending) and html:
+                i = pending[pos]
+                results[i] = html
+                cache.set(keys[i], html)
+
+    # Cached and batched outputs still hold data URI placeholders
+    for i, out in enumerate(results):
+        if out is not None:
+            results[i] = _restore_data_uris(out)
+
+    for i in pending:
+        if results[i] is None:
+            try:
+                results[i] = await rewrite_item_async(
+                    client, items_batch[i], item_contexts[i], global_instructions, model_name, deltas
+                )
+            except Exception as e:
+                results[i] = e
+
+    return results
+
+
+
+# ---------- CONTENT ITEMS ----------
+
+# content_items is stored column-wise: one list per field, index i across all lists is item i.
+CONTENT_FIELDS = (
+    "type",
+    "id",
+    "canvas_id",
+    "url_slug",
+    "title",
+    "original_html",
+    "rewritten_html",
+    "approved",
+    "rewrite_error",
+)
+
+
+def empty_content_items() -> Dict[str, List[Any]]:
+    return {field: [] for field in CONTENT_FIELDS}
+
+
+def build_content_items(
+    pages: List[Dict[str, Any]],
+    assignments: List[Dict[str, Any]],
+    discussions: List[Dict[str, Any]],
+) -> Dict[str, List[Any]]:
+    """Turn Canvas API objects into the columnar content_items structure."""
+    n = len(pages) + len(assignments) + len(discussions)
+    ids = [p["page_id"] for p in pages] + [a["id"] for a in assignments] + [d["id"] for d in discussions]
+    return {
+        "type": ["page"] * len(pages) + ["assignment"] * len(assignments) + ["discussion"] * len(discussions),
+        "id": ids,
+        "canvas_id": list(ids),
+        "url_slug": [p["url"] for p in pages] + [None] * (len(assignments) + len(discussions)),
+        "title": [p["title"] for p in pages] + [a["name"] for a in assignments] + [d["title"] for d in discussions],
+        "original_html": (
+            [p.get("body", "") or "" for p in pages]
+            + [a.get("description", "") or "" for a in assignments]
+            + [d.get("message", "") or "" for d in discussions]
+        ),
+        "rewritten_html": [""] * n,
+        "approved": [False] * n,
+        "rewrite_error": [""] * n,
+    }
+
+
+def changed_mask(ci: Dict[str, List[Any]]) -> List[bool]:
+    """Items with a proposal that actually differs from the original (skipped items keep their HTML)."""
+    return [bool(new) and new != old for new, old in zip(ci["rewritten_html"], ci["original_html"])]
+
+
+def content_row(ci: Dict[str, List[Any]], i: int) -> Dict[str, Any]:
+    """Item i as a plain dict, for helpers that work on a single item."""
+    return {field: ci[field][i] for field in CONTENT_FIELDS}
+
+
+# ---------- PERSISTENCE ----------
+
+@st.cache_resource(show_spinner=False)
+def state_cache() -> diskcache.Cache:
+    """
+    On-disk copy of fetched course content (keyed by course ID) and of model contexts built
+    from a Canvas model course, so a browser reload or code edit doesn't have to refetch from Canvas.
+    Also records the content hash of every rewrite written back, so it is never rewritten again.
+    """
+    return diskcache.Cache(os.path.join(CACHE_DIR, "state"))
+
+
+def save_state(kind: str, key: str, value: Any) -> None:
+    state_cache().set((kind, key), value)
+
+
+def load_state(kind: str, key: str) -> Optional[Any]:
+    return state_cache().get((kind, key))
+
+
+def save_course_state() -> None:
+    course_id = st.session_state["course_id"]
+    save_state(
+        "course",
+        str(course_id),
+        {"course_id": course_id, "content_items": st.session_state["content_items"]},
+    )
+
+
+def save_model_state(key: str) -> None:
+    save_state(
+        "model",
+        key,
+        {
+            "model_context": st.session_state["model_context"],
+            "model_snippets": st.session_state["model_snippets"],
+            "model_vecs": st.session_state["model_vecs"],
+        },
+    )
+
 
 # ---------- STREAMLIT STATE INIT ----------
 
 if "content_items" not in st.session_state:
-    st.session_state["content_items"] = []  # list of dicts
+    st.session_state["content_items"] = empty_content_items()
 
+# Nothing is restored automatically: cached course content and model contexts are only loaded
+# for the course IDs this session enters (sidebar / Step 2).
 if "model_context" not in st.session_state:
     st.session_state["model_context"] = ""
+    st.session_state["model_snippets"] = []  # Canvas model course only
+    st.session_state["model_vecs"] = None  # embeddings of model_snippets, when configured
 
 if "course_id" not in st.session_state:
     st.session_state["course_id"] = None
@@ -320,10 +941,22 @@ target_course_id = st.sidebar.text_input(
     "Target course ID",
     help="Numeric ID from the Canvas course URL (e.g. .../courses/205033).",
 )
+use_cached_course = st.sidebar.checkbox(
+    "Use cached copy if available",
+    help="Load this course's content (and any rewrites) saved by an earlier fetch instead of calling Canvas.",
+)
 
 if st.sidebar.button("Fetch course content"):
     if not target_course_id:
         st.sidebar.error("Please provide a target course ID.")
+    elif use_cached_course and (cached_course := load_state("course", str(target_course_id))):
+        st.session_state["content_items"] = cached_course["content_items"]
+        st.session_state["course_id"] = cached_course["course_id"]
+        st.session_state["rewrite_done"] = False
+        st.success(
+            f"Loaded {len(cached_course['content_items']['type'])} items "
+            f"from the cached copy of course {target_course_id}."
+        )
     else:
         base_url, token = get_canvas_config()
         try:
@@ -331,57 +964,24 @@ if st.sidebar.button("Fetch course content"):
                 # verify course exists (optional)
                 _ = get_course(base_url, token, target_course_id)
 
-                pages = get_pages(base_url, token, target_course_id)
-                assignments = get_assignments(base_url, token, target_course_id)
-                discussions = get_discussions(base_url, token, target_course_id)
-
-                content_items: List[Dict[str, Any]] = []
-
-                for p in pages:
-                    content_items.append(
-                        {
-                            "type": "page",
-                            "id": p["page_id"],   # internal id
-                            "canvas_id": p["page_id"],
-                            "url_slug": p["url"],
-                            "title": p["title"],
-                            "original_html": p.get("body", "") or "",
-                            "rewritten_html": "",
-                            "approved": False,
-                        }
-                    )
-
-                for a in assignments:
-                    content_items.append(
-                        {
-                            "type": "assignment",
-                            "id": a["id"],
-                            "canvas_id": a["id"],
-                            "title": a["name"],
-                            "original_html": a.get("description", "") or "",
-                            "rewritten_html": "",
-                            "approved": False,
-                        }
-                    )
-
-                for d in discussions:
-                    content_items.append(
-                        {
-                            "type": "discussion",
-                            "id": d["id"],
-                            "canvas_id": d["id"],
-                            "title": d["title"],
-                            "original_html": d.get("message", "") or "",
-                            "rewritten_html": "",
-                            "approved": False,
-                        }
-                    )
+                # The three endpoints are independent, so fetch them side by side
+                with ThreadPoolExecutor(max_workers=3) as ex:
+                    future_pages = ex.submit(fetch_pages, base_url, token, target_course_id)
+                    future_assignments = ex.submit(get_assignments, base_url, token, target_course_id)
+                    future_discussions = ex.submit(get_discussions, base_url, token, target_course_id)
+
+                content_items = build_content_items(
+                    future_pages.result(),
+                    future_assignments.result(),
+                    future_discussions.result(),
+                )
 
                 st.session_state["content_items"] = content_items
                 st.session_state["course_id"] = target_course_id
                 st.session_state["rewrite_done"] = False
+                save_course_state()
 
-            st.success(f"Loaded {len(content_items)} items from course {target_course_id}.")
+            st.success(f"Loaded {len(content_items['type'])} items from course {target_course_id}.")
 
         except Exception as e:
             st.sidebar.error(f"Error fetching content: {e}")
@@ -405,6 +1005,8 @@ if model_source == "Paste HTML/JSON":
     )
     if st.button("Use this as model"):
         st.session_state["model_context"] = pasted or ""
+        st.session_state["model_snippets"] = []
+        st.session_state["model_vecs"] = None
         st.success("Model context updated from pasted content.")
 
 elif model_source == "Upload a file":
@@ -415,6 +1017,8 @@ elif model_source == "Upload a file":
     if uploaded is not None and st.button("Use uploaded file as model"):
         content = uploaded.read().decode("utf-8", errors="ignore")
         st.session_state["model_context"] = content
+        st.session_state["model_snippets"] = []
+        st.session_state["model_vecs"] = None
         st.success("Model context loaded from uploaded file.")
 
 elif model_source == "Use Canvas model course":
@@ -429,31 +1033,59 @@ elif model_source == "Use Canvas model course":
         value=10,
         step=1,
     )
+    use_cached_model = st.checkbox(
+        "Use cached copy if available",
+        key="use_cached_model",
+        help="Load the model context saved by an earlier fetch of this course (with the same item limit) instead of calling Canvas.",
+    )
     if st.button("Fetch model course content"):
+        model_key = hashlib.sha256(f"{model_course_id}:{max_model_items}".encode("utf-8")).hexdigest()
         if not model_course_id:
             st.error("Model course ID is required.")
+        elif use_cached_model and (cached_model := load_state("model", model_key)):
+            st.session_state["model_context"] = cached_model["model_context"]
+            st.session_state["model_snippets"] = cached_model["model_snippets"]
+            st.session_state["model_vecs"] = cached_model["model_vecs"]
+            st.success(f"Model context loaded from the cached copy of course {model_course_id}.")
         else:
             base_url, token = get_canvas_config()
             try:
                 with st.spinner("Fetching model course content…"):
                     # Simple strategy: a few pages, assignments, discussions
-                    pages_m = get_pages(base_url, token, model_course_id, max_items=max_model_items)
-                    assignments_m = get_assignments(base_url, token, model_course_id, max_items=max_model_items)
-                    discussions_m = get_discussions(base_url, token, model_course_id, max_items=max_model_items)
+                    with ThreadPoolExecutor(max_workers=3) as ex:
+                        future_pages = ex.submit(fetch_pages, base_url, token, model_course_id, max_items=max_model_items)
+                        future_assignments = ex.submit(get_assignments, base_url, token, model_course_id, max_items=max_model_items)
+                        future_discussions = ex.submit(get_discussions, base_url, token, model_course_id, max_items=max_model_items)
+                    pages_m = future_pages.result()
+                    assignments_m = future_assignments.result()
+                    discussions_m = future_discussions.result()
 
                     model_snippets = []
 
                     for p in pages_m[:max_model_items]:
-                        model_snippets.append(f"### [page] {p['title']}\n{p.get('body', '')}")
+                        model_snippets.append(f"### [page] {p['title']}\n{_compact_html(_stash_data_uris(p.get('body') or ''))}")
 
                     for a in assignments_m[:max_model_items]:
-                        model_snippets.append(f"### [assignment] {a['name']}\n{a.get('description', '')}")
+                        model_snippets.append(f"### [assignment] {a['name']}\n{_compact_html(_stash_data_uris(a.get('description') or ''))}")
 
                     for d in discussions_m[:max_model_items]:
-                        model_snippets.append(f"### [discussion] {d['title']}\n{d.get('message', '')}")
+                        model_snippets.append(f"### [discussion] {d['title']}\n{_compact_html(_stash_data_uris(d.get('message') or ''))}")
 
                     model_context = "\n\n".join(model_snippets)
                     st.session_state["model_context"] = model_context
+                    st.session_state["model_snippets"] = model_snippets
+                    st.session_state["model_vecs"] = None
+
+                    embedding_model = get_embedding_model()
+                    if embedding_model and model_snippets:
+                        try:
+                            st.session_state["model_vecs"] = embed_texts(
+                                get_ai_client(), embedding_model, model_snippets
+                            )
+                        except Exception as e:
+                            st.warning(f"Could not embed model snippets; every item will get the full model context. ({e})")
+
+                    save_model_state(model_key)
 
                 st.success("Model context built from Canvas model course.")
 
@@ -482,32 +1114,170 @@ global_instructions = st.text_area(
 )
 
 can_run_rewrite = bool(
-    st.session_state["content_items"]
+    st.session_state["content_items"]["type"]
     and st.session_state["model_context"]
 )
 
+concurrency = st.slider(
+    "Concurrent rewrite requests",
+    min_value=2,
+    max_value=8,
+    value=4,
+    help="How many items are sent to Azure OpenAI at once. Lower this if you hit rate limits.",
+)
+
 if st.button("Run rewrite on all items", disabled=not can_run_rewrite):
-    client = get_ai_client()
-    items = st.session_state["content_items"]
+    from openai import RateLimitError
+
+    client = get_ai_client(async_client=True)
+    model_name = get_model_name()
+    ci = st.session_state["content_items"]
     model_context = st.session_state["model_context"]
 
     progress = st.progress(0.0)
     status_area = st.empty()
-
-    for idx, item in enumerate(items):
-        status_area.write(f"Rewriting [{item['type']}] {item['title']}…")
+    live_area = st.empty()
+    # Errors only describe the latest run
+    ci["rewrite_error"] = [""] * len(ci["type"])
+
+    # Identical HTML (e.g. weekly template pages) is rewritten once and fanned out to every copy
+    groups: Dict[str, List[int]] = {}
+    for i, html in enumerate(ci["original_html"]):
+        if not html:
+            ci["rewritten_html"][i] = ""
+            continue
+        h = html_hash(html)
+        if not _significant(html) or load_state("written", h):
+            # Nothing worth restyling, or an approved rewrite Step 5 already wrote back: keep as is
+            ci["rewritten_html"][i] = html
+        else:
+            groups.setdefault(h, []).append(i)
+    total = sum(len(group) for group in groups.values())
+    representatives = [content_row(ci, group[0]) for group in groups.values()]
+    batches = plan_rewrite_batches(representatives)
+
+    # Pick the most relevant model snippets per item instead of sending all of them
+    model_snippets = st.session_state["model_snippets"]
+    model_vecs = st.session_state["model_vecs"]
+    embedding_model = get_embedding_model()
+    snippets_by_hash: Dict[str, List[tuple[int, float]]] = {}
+    if model_vecs is not None and embedding_model and representatives:
         try:
-            if item.get("original_html"):
-                rewritten = rewrite_item(client, item, model_context, global_instructions)
-                item["rewritten_html"] = rewritten
-            else:
-                item["rewritten_html"] = ""
+            item_vecs = embed_texts(
+                get_ai_client(),
+                embedding_model,
+                [f"{row['title']}\n{_prompt_html(row)[:EMBED_INPUT_CHARS]}" for row in representatives],
+            )
+            snippets_by_hash = dict(zip(groups, top_snippets(item_vecs, model_vecs)))
         except Exception as e:
-            item["rewrite_error"] = str(e)
-
-        progress.progress((idx + 1) / len(items))
-
-    st.session_state["content_items"] = items
+            st.warning(f"Could not rank model snippets; using the full model context. ({e})")
+    rewrite_by_hash: Dict[str, str] = {}
+    error_by_hash: Dict[str, str] = {}
+
+    async def _rewrite_batch(
+        sem: asyncio.Semaphore,
+        batch: List[Dict[str, Any]],
+        deltas: asyncio.Queue,
+    ) -> int:
+        hashes = [html_hash(item["original_html"]) for item in batch]
+        context = model_context
+        item_contexts = None
+        if snippets_by_hash:
+            # Best matches first, so any truncation drops the weakest snippets
+            picked = rank_batch_snippets([snippets_by_hash[h] for h in hashes])
+            context = "\n\n".join(model_snippets[j] for j in picked)
+            item_contexts = [
+                "\n\n".join(model_snippets[j] for j, _ in snippets_by_hash[h]) for h in hashes
+            ]
+        async with sem:
+            try:
+                rewritten = await rewrite_items_batch(
+                    client, batch, context, global_instructions, model_name, deltas, item_contexts
+                )
+            except Exception as e:
+                rewritten = [e] * len(batch)
+        for h, out in zip(hashes, rewritten):
+            if isinstance(out, RateLimitError):
+                error_by_hash[h] = f"Rate limited: {out}"
+            elif isinstance(out, Exception):
+                error_by_hash[h] = str(out)
+            else:
+                rewrite_by_hash[h] = out
+        return sum(len(groups[h]) for h in hashes)
+
+    async def _refresh_ui(deltas: asyncio.Queue, counts: Dict[str, int]) -> None:
+        # The only coroutine that touches the page: drains streamed text and redraws at a fixed rate
+        partial: Dict[str, str] = {}
+        latest: Optional[str] = None
+        shown = -1
+        running = True
+        while running:
+            await asyncio.sleep(UI_REFRESH_SECONDS)
+            while not deltas.empty():
+                msg = deltas.get_nowait()
+                if msg is None:
+                    running = False
+                    break
+                label, delta = msg
+                partial[label] = partial.get(label, "") + delta
+                latest = label
+
+            if latest is not None:
+                # Show the tail of whichever response most recently produced text
+                with live_area.container():
+                    st.caption(f"Receiving {latest}…")
+                    st.code(partial[latest][-1500:], language="html")
+                latest = None
+            if counts["done"] != shown:
+                shown = counts["done"]
+                status_area.write(f"Rewrote {shown} of {total} items…")
+                progress.progress(shown / total if total else 1.0)
+
+    async def _run_all() -> None:
+        sem = asyncio.Semaphore(concurrency)
+        deltas: asyncio.Queue = asyncio.Queue()
+        counts = {"done": 0}
+        tasks = [asyncio.create_task(_rewrite_batch(sem, batch, deltas)) for batch in batches]
+        ui = asyncio.create_task(_refresh_ui(deltas, counts))
+
+        def _stop_on_ui_failure(task: asyncio.Task) -> None:
+            # Stop/rerun surfaces as an exception from the first st.* call in the UI task;
+            # don't keep paying for rewrites nobody will see
+            if not task.cancelled() and task.exception() is not None:
+                for t in tasks:
+                    t.cancel()
+
+        ui.add_done_callback(_stop_on_ui_failure)
+        try:
+            for finished in asyncio.as_completed(tasks):
+                try:
+                    counts["done"] += await finished
+                except asyncio.CancelledError:
+                    break
+        finally:
+            for t in tasks:
+                t.cancel()
+            deltas.put_nowait(None)
+            try:
+                await ui  # re-raises Streamlit's stop/rerun exception, if that is what ended the run
+            finally:
+                await client.close()
+
+    try:
+        asyncio.run(_run_all())
+    finally:
+        # Keep every batch that finished, even when the run was interrupted
+        for h, group in groups.items():
+            for i in group:
+                if h in rewrite_by_hash:
+                    ci["rewritten_html"][i] = rewrite_by_hash[h]
+                elif h in error_by_hash:
+                    ci["rewrite_error"][i] = error_by_hash[h]
+        st.session_state["content_items"] = ci
+        save_course_state()
+
+    progress.progress(1.0)
+    live_area.empty()
     st.session_state["rewrite_done"] = True
     status_area.write("Rewrite complete.")
 
@@ -516,55 +1286,62 @@ if st.button("Run rewrite on all items", disabled=not can_run_rewrite):
 
 st.header("Step 4 – Review and approve changes")
 
-items = st.session_state["content_items"]
+ci = st.session_state["content_items"]
 
-if not items:
+if not ci["type"]:
     st.info("Load course content first using the sidebar.")
 else:
-    for i, item in enumerate(items):
-        has_rewrite = bool(item.get("rewritten_html"))
-        label = f"[{item['type']}] {item['title']}"
+    changed = changed_mask(ci)
+    for i in range(len(ci["type"])):
+        has_rewrite = bool(ci["rewritten_html"][i])
+        label = f"[{ci['type'][i]}] {ci['title'][i]}"
         with st.expander(label, expanded=False):
+            # Collapsed expanders still mount their iframes, so only render previews on request
+            show_preview = st.toggle("Show preview", key=f"opened_{i}")
+            if show_preview:
+                import streamlit.components.v1 as components
             col1, col2 = st.columns(2)
 
             with col1:
                 st.subheader("Original (visual)")
-                if item.get("original_html"):
-                    components.html(item["original_html"], height=350, scrolling=True)
-                else:
+                if not ci["original_html"][i]:
                     st.info("No HTML body for this item.")
+                elif show_preview:
+                    components.html(ci["original_html"][i], height=350, scrolling=True)
 
             with col2:
                 st.subheader("Proposed (visual)")
-                if has_rewrite:
-                    components.html(item["rewritten_html"], height=350, scrolling=True)
+                if ci["rewrite_error"][i]:
+                    st.error(f"Rewrite failed: {ci['rewrite_error'][i]}")
+                if not has_rewrite:
+                    if not ci["rewrite_error"][i]:
+                        st.warning("No rewrite available yet. Run the rewrite step above.")
+                elif not changed[i]:
+                    st.info("No changes proposed; this item is kept as is.")
+                elif show_preview:
+                    components.html(ci["rewritten_html"][i], height=350, scrolling=True)
                     st.caption("Proposed version based on model + instructions.")
-                else:
-                    st.warning("No rewrite available yet. Run the rewrite step above.")
 
-            approved = st.checkbox(
+            ci["approved"][i] = st.checkbox(
                 "Approve this change",
-                value=item.get("approved", False),
+                value=ci["approved"][i],
                 key=f"approved_{i}",
+                disabled=not changed[i],
             )
-            item["approved"] = approved
 
-    # Write back the mutated list
-    st.session_state["content_items"] = items
+    # Write back the mutated columns
+    st.session_state["content_items"] = ci
 
     # Bulk helpers
     col_a, col_b = st.columns(2)
     with col_a:
         if st.button("Approve ALL items with proposed HTML"):
-            for item in st.session_state["content_items"]:
-                if item.get("rewritten_html"):
-                    item["approved"] = True
+            ci["approved"] = [a or c for a, c in zip(ci["approved"], changed_mask(ci))]
             st.success("All items with proposed HTML marked as approved.")
 
     with col_b:
         if st.button("Clear ALL approvals"):
-            for item in st.session_state["content_items"]:
-                item["approved"] = False
+            ci["approved"] = [False] * len(ci["approved"])
             st.info("All approvals cleared.")
 
 
@@ -578,44 +1355,35 @@ if st.button("Write approved changes to Canvas"):
     else:
         base_url, token = get_canvas_config()
         course_id = st.session_state["course_id"]
-        approved_items = [
-            it for it in st.session_state["content_items"]
-            if it.get("approved") and it.get("rewritten_html")
-        ]
+        ci = st.session_state["content_items"]
+        mask = [a and c for a, c in zip(ci["approved"], changed_mask(ci))]
+        approved_items = [content_row(ci, i) for i, keep in enumerate(mask) if keep]
 
         if not approved_items:
             st.warning("No approved items with rewritten HTML to write back.")
         else:
-            with st.spinner(f"Writing {len(approved_items)} items back to Canvas…"):
-                errors = []
-                for item in approved_items:
+            progress = st.progress(0.0, text=f"Writing {len(approved_items)} items back to Canvas…")
+            errors = []
+            with ThreadPoolExecutor(max_workers=8) as ex:
+                futures = {
+                    ex.submit(update_item_html, base_url, token, course_id, item): item
+                    for item in approved_items
+                }
+                last_refresh = 0.0
+                for done, future in enumerate(as_completed(futures), start=1):
+                    item = futures[future]
                     try:
-                        if item["type"] == "page":
-                            update_page_html(
-                                base_url,
-                                token,
-                                course_id,
-                                item["url_slug"],
-                                item["rewritten_html"],
-                            )
-                        elif item["type"] == "assignment":
-                            update_assignment_html(
-                                base_url,
-                                token,
-                                course_id,
-                                item["canvas_id"],
-                                item["rewritten_html"],
-                            )
-                        elif item["type"] == "discussion":
-                            update_discussion_html(
-                                base_url,
-                                token,
-                                course_id,
-                                item["canvas_id"],
-                                item["rewritten_html"],
-                            )
+                        future.result()
+                        save_state("written", html_hash(item["rewritten_html"]), True)
                     except Exception as e:
                         errors.append((item["title"], str(e)))
+                    now = time.monotonic()
+                    if done == len(approved_items) or now - last_refresh >= UI_REFRESH_SECONDS:
+                        last_refresh = now
+                        progress.progress(
+                            done / len(approved_items),
+                            text=f"Wrote {done} of {len(approved_items)} items to Canvas…",
+                        )
 
             if errors:
                 st.error("Some items failed to update:")